@@ -13,9 +13,14 @@ Dependencies:
 - JSON: Handling JSON data.
 - OS: Provides a way of using operating system-dependent functionality.
 - urllib.parse: Parse URLs.
-- Math: Mathematical functions.
-- Datetime: Manipulate dates and times.
+- Time: Format timestamps.
 - Logging: Logging library for error tracking.
+- Queue: Hands log records to a background thread that writes the log file.
+- Cachetools: In-process TTL cache for values that change rarely between requests.
+- Orjson: Fast JSON serialization used for the app's JSON responses.
+- Flask-Caching: Memoizes the home feed queries between requests, in a cache directory shared
+by all worker processes.
+- Tempfile: Locates the default cache directory.
 
 Usage:
 - Run the application by executing this file.
@@ -24,23 +29,61 @@ Usage:
 user administration, etc.
 """
 import json
+import base64
+import binascii
+import os.path
 from os import environ as env
+import tempfile
 from urllib.parse import quote_plus, urlencode
-import math
-from datetime import datetime
+import time
 import logging
+import logging.handlers
+import queue
+import atexit
+import threading
+from functools import lru_cache
+from cachetools import TTLCache
+import orjson
 from authlib.integrations.flask_client import OAuth
 from dotenv import find_dotenv, load_dotenv
-from flask import Flask, jsonify, render_template, session, redirect, url_for
-from sqlalchemy import func, case
-from update_database import NewsItem, Session, add_user, LikesAndDislikes, User, add_like_dislike
+from flask import Flask, jsonify, render_template, request, session, redirect, url_for
+from flask.json.provider import DefaultJSONProvider
+from flask_caching import Cache
+from sqlalchemy import func, tuple_
+from update_database import (NewsItem, ReadSession, User, WriteSession, add_like_dislike,
+                             upsert_user_return_admin)
 
 ENV_FILE = find_dotenv()
 if ENV_FILE:
     load_dotenv(ENV_FILE)
 
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    JSON provider that serializes and parses with orjson instead of the standard json module.
+
+    Keys are sorted like Flask's default provider, and types orjson does not handle
+    natively fall back to Flask's default conversion. The provider also serializes the
+    session cookie, so non-string dict keys are converted to strings as the json module
+    does instead of being rejected.
+    """
+    def dumps(self, obj, **kwargs):
+        """Serialize obj to a JSON string."""
+        return orjson.dumps(obj, default=self.default,
+                            option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        """Deserialize a JSON string or bytes."""
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.secret_key = env.get("APP_SECRET_KEY")
+# The memoized home feed lives on disk so that every worker process sees the same entries;
+# a vote or user deletion handled by one worker then invalidates the feed for all of them
+cache = Cache(app, config={
+    'CACHE_TYPE': 'FileSystemCache',
+    'CACHE_DIR': env.get("CACHE_DIR", os.path.join(tempfile.gettempdir(), 'newsfeed_cache')),
+})
 
 #Auth0
 oauth = OAuth(app)
@@ -55,16 +98,84 @@ oauth.register(
     server_metadata_url=f'https://{env.get("AUTH0_DOMAIN")}/.well-known/openid-configuration'
 )
 
-def get_home_feed(page, per_page=10):
+# The number of news items only changes when update_database.py runs,
+# so it is shared between page views for up to a minute
+# (cachetools caches are not thread-safe, hence the lock)
+_count_cache = TTLCache(maxsize=1, ttl=60)
+_count_lock = threading.Lock()
+
+# Columns selected for the news feeds and the dictionary keys they are returned under.
+# The home page does not render the text, so only the JSON feed loads it.
+SUMMARY_COLUMNS = (NewsItem.id, NewsItem.title, NewsItem.by, NewsItem.url,
+                   NewsItem.descendants, NewsItem.score, NewsItem.time)
+SUMMARY_FIELDS = ('id', 'title', 'by', 'url', 'descendants', 'score', 'time')
+NEWS_COLUMNS = SUMMARY_COLUMNS + (NewsItem.text,)
+NEWS_FIELDS = SUMMARY_FIELDS + ('text',)
+HOME_FEED_COLUMNS = SUMMARY_COLUMNS + (NewsItem.likes_count, NewsItem.dislikes_count)
+HOME_FEED_FIELDS = SUMMARY_FIELDS + ('likes', 'dislikes')
+# Home feed ordering; the last item's values for these keys make up the page cursor
+HOME_FEED_ORDER = (NewsItem.likes_count, NewsItem.dislikes_count, NewsItem.time, NewsItem.id)
+CURSOR_FIELDS = ('likes', 'dislikes', 'time', 'id')
+
+def encode_cursor(news_item):
+    """
+    Encode the position of a home feed item as an opaque, URL-safe cursor.
+
+    Parameters:
+    - news_item (dict): A news item as returned by get_home_feed.
+
+    Returns:
+    str: The cursor pointing just after the given news item.
+    """
+    position = [news_item[field] for field in CURSOR_FIELDS]
+    return base64.urlsafe_b64encode(orjson.dumps(position)).decode()
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor created by encode_cursor.
+
+    Parameters:
+    - cursor (str): The cursor taken from the request.
+
+    Returns:
+    List[int] or None: The (likes, dislikes, time, id) position, or None if the cursor
+    is missing or malformed.
+    """
+    if not cursor:
+        return None
+    try:
+        position = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError):
+        return None
+    if (not isinstance(position, list) or len(position) != len(CURSOR_FIELDS)
+            or not all(_is_sqlite_integer(value) for value in position)):
+        return None
+    return position
+
+def _is_sqlite_integer(value):
+    """
+    Check that a decoded cursor value can be bound as a SQLite INTEGER, i.e. that it is an
+    int (but not a bool) within the signed 64-bit range.
+    """
+    return (isinstance(value, int) and not isinstance(value, bool)
+            and -2**63 <= value < 2**63)
+
+@cache.memoize(timeout=30)
+def get_home_feed(page, per_page=10, cursor=None):
     """
-    Retrieve a paginated list of news items with aggregated likes and dislikes.
+    Retrieve a paginated list of news items ranked by their likes and dislikes.
 
     Parameters:
     - page (int): Page number to retrieve.
     - per_page (int, optional): Number of items per page (default is 10).
+    - cursor (List[int], optional): Position of the last item on the previous page, as
+    returned by decode_cursor. When given, the page starts right after that item instead
+    of skipping (page - 1) * per_page rows.
 
     Returns:
     Tuple[List[Dict[str, Any]], int]: Paginated news items and total count.
+    Results are memoized per (page, per_page, cursor) for 30 seconds in the cache shared by
+    all workers and dropped when likes, dislikes or users change.
 
     Each news item is represented as a dictionary with keys:
     - 'id' (int): Unique identifier.
@@ -74,56 +185,30 @@ def get_home_feed(page, per_page=10):
     - 'descendants' (int): Number of comments.
     - 'score' (int): Item score.
     - 'time' (int): Timestamp.
-    - 'text' (str): Text content.
     - 'likes' (int): Total likes.
     - 'dislikes' (int): Total dislikes.
     """
-    session = Session()
-    offset = (page - 1) * per_page
-
-    # Subquery for aggregated data
-    likes_dislikes_subq = session.query(
-        LikesAndDislikes.news_item_id,
-        func.coalesce(func.sum(case((LikesAndDislikes.like == True, 1), else_=0)), 0) # pylint: disable=not-callable
-        .label('total_likes'),
-        func.coalesce(func.sum(case((LikesAndDislikes.like == False, 1), else_=0)), 0) # pylint: disable=not-callable
-        .label('total_dislikes')
-        ).group_by(LikesAndDislikes.news_item_id).subquery()
-
-    # join NewsItem with aggregated likes/dislikes
-    latest_news_query = session.query(NewsItem, likes_dislikes_subq.c.total_likes,
-                                      likes_dislikes_subq.c.total_dislikes
-                                      ).outerjoin(
-                                          likes_dislikes_subq,
-                                          NewsItem.id == likes_dislikes_subq.c.news_item_id
-                                      ).order_by(
-                                          likes_dislikes_subq.c.total_likes.desc(),
-                                          likes_dislikes_subq.c.total_dislikes.desc(),
-                                          NewsItem.time.desc())
-
-    latest_news_paginated = latest_news_query.offset(offset).limit(per_page).all()
-
-    news_list = []
-    for news_item_tuple in latest_news_paginated:
-        news_item = news_item_tuple[0]
-        total_likes = news_item_tuple[1] if news_item_tuple[1] is not None else 0
-        total_dislikes = news_item_tuple[2] if news_item_tuple[2] is not None else 0
-
-        news_list.append({
-            'id': news_item.id,
-            'title': news_item.title,
-            'by': news_item.by,
-            'url': news_item.url,
-            'descendants': news_item.descendants,
-            'score': news_item.score,
-            'time': news_item.time,
-            'text': news_item.text,
-            'likes': total_likes,
-            'dislikes': total_dislikes
-        })
-
-    session.close()
-    total = latest_news_query.count()
+    with ReadSession() as session:
+        # The like/dislike counters are stored on NewsItem, so no aggregation is needed
+        latest_news_query = session.query(*HOME_FEED_COLUMNS).order_by(
+            *(column.desc() for column in HOME_FEED_ORDER))
+        if cursor:
+            # Seek past the previous page on the index rather than counting off an offset
+            latest_news_query = latest_news_query.filter(
+                tuple_(*HOME_FEED_ORDER) < tuple_(*cursor))
+        else:
+            latest_news_query = latest_news_query.offset((page - 1) * per_page)
+        latest_news_paginated = latest_news_query.limit(per_page).all()
+
+        news_list = [dict(zip(HOME_FEED_FIELDS, row)) for row in latest_news_paginated]
+
+        # Pagination only needs the number of news items, not the likes ordering
+        with _count_lock:
+            total = _count_cache.get('total')
+        if total is None:
+            total = session.query(func.count(NewsItem.id)).scalar() # pylint: disable=not-callable
+            with _count_lock:
+                _count_cache['total'] = total
     return news_list, total
 
 def handle_like_dislike(news_item_id, like):
@@ -147,10 +232,29 @@ def handle_like_dislike(news_item_id, like):
         return redirect(url_for('home', error="User not logged in"))
 
     if add_like_dislike(email, news_item_id, like):
+        cache.delete_memoized(get_home_feed)
         return redirect(url_for('home'))
 
     return redirect(url_for('home', error="Unable to process like/dislike"))
 
+@lru_cache(maxsize=8192)
+def _format_timestamp(value, format):
+    """
+    Format a UTC timestamp, remembering the result for repeated timestamps.
+
+    Parameters:
+    - value (int): The timestamp value to be formatted.
+    - format (str): The format string for the output.
+
+    Returns:
+    str: A formatted string representing the timestamp, or an empty string if there is
+    no timestamp.
+    """
+    # time.gmtime(None) would return, and cache, the current time
+    if value is None:
+        return ''
+    return time.strftime(format, time.gmtime(value))
+
 @app.template_filter('datetimeformat')
 def datetimeformat(value, format='%Y-%m-%d %H:%M:%S'):
     """
@@ -163,12 +267,63 @@ def datetimeformat(value, format='%Y-%m-%d %H:%M:%S'):
     Returns:
     str: A formatted string representing the timestamp.
     """
-    return datetime.utcfromtimestamp(value).strftime(format)
+    return _format_timestamp(value, format)
+
+@lru_cache(maxsize=4096)
+def cached_url_for(endpoint, **values):
+    """
+    Build a URL for the given endpoint, remembering the result for repeated arguments.
+
+    Templates build the same pagination, like/dislike and static URLs on every render,
+    so the URL map only has to be walked once per distinct set of arguments.
+
+    Parameters:
+    - endpoint (str): The endpoint name passed to url_for.
+    - values: Hashable URL arguments passed to url_for.
+
+    Returns:
+    str: The URL generated by url_for.
+    """
+    return url_for(endpoint, **values)
+
+app.jinja_env.globals['url_for'] = cached_url_for
+
+def pretty_session():
+    """
+    Pretty-print the user session data for debugging in templates.
+
+    Only templates that call pretty_session() pay for the indented JSON dump.
+
+    Returns:
+    str: The user session data as indented JSON.
+    """
+    return json.dumps(session.get('user'), indent=4)
+
+app.jinja_env.globals['pretty_session'] = pretty_session
 
 #Error Checking
+# Requests only enqueue log records; a background thread writes them to the file
 app.logger.setLevel(logging.ERROR)
 FILE_HANDLER = logging.FileHandler("/home/marija8t/project_part2/error.log")
-app.logger.addHandler(FILE_HANDLER)
+LOG_QUEUE = queue.SimpleQueue()
+LOG_LISTENER = logging.handlers.QueueListener(LOG_QUEUE, FILE_HANDLER)
+LOG_LISTENER.start()
+atexit.register(LOG_LISTENER.stop)
+app.logger.addHandler(logging.handlers.QueueHandler(LOG_QUEUE))
+
+@app.teardown_appcontext
+def remove_db_session(exception=None): # pylint: disable=unused-argument
+    """
+    Release the thread-local database sessions at the end of each request.
+
+    Parameters:
+    - exception (Exception, optional): The unhandled exception raised by the request, if any.
+
+    Returns:
+    None
+    """
+    ReadSession.remove()
+    WriteSession.remove()
 
 #ROUTES
 @app.route('/sessioncheck')
@@ -198,14 +353,13 @@ def delete_user(user_id):
     if 'user' not in session or not session['user'].get('admin'):
         return redirect(url_for('login'))
 
-    with Session() as db_session:
+    with WriteSession() as db_session:
         user = db_session.query(User).filter_by(id=user_id).first()
         if user:
-            # Delete likes and dislikes first
-            db_session.query(LikesAndDislikes).filter_by(user_id=user.id).delete()
-            # Now delete user
+            # Their likes and dislikes are removed by the ON DELETE CASCADE
             db_session.delete(user)
             db_session.commit()
+            cache.delete_memoized(get_home_feed)
         else:
             app.logger.error("User ID %s not found.", user_id)
 
@@ -237,7 +391,7 @@ def make_user_admin(email):
     Returns:
     None
     """
-    with Session() as session:
+    with WriteSession() as session:
         user = session.query(User).filter_by(email=email).first()
         if user:
             user.admin = True
@@ -260,7 +414,7 @@ def admin():
         return redirect(url_for('home'))
 
     # Using a different name for the SQLAlchemy session to avoid conflict
-    with Session() as db_session:
+    with ReadSession() as db_session:
         users = db_session.query(User).all()
         return render_template('admin.html', users=users)
 
@@ -326,8 +480,8 @@ def callback():
     Notes:
     - Obtains the access token from the Auth0 authorization server.
     - Sets the user session data using the obtained token.
-    - Retrieves user information from the ID token and adds the user to the database.
-    - Queries the database for the user's admin status and updates the session accordingly.
+    - Retrieves user information from the ID token, adds the user to the database and
+    reads back the user's admin status in one query, updating the session accordingly.
     - Redirects to the home page after processing the callback.
     """
     token = oauth.auth0.authorize_access_token()
@@ -339,14 +493,8 @@ def callback():
         username = user_info.get("name")
         email = user_info.get("email")
 
-        add_user(username, email)
-        # Query the User table for the admin status
-        with Session() as db_session:
-            user = db_session.query(User).filter_by(email=email).first()
-            if user:
-                session['user']['admin'] = user.admin
-            else:
-                app.logger.error("User %s not found in database for admin status.", email)
+        # Add the user and read back the admin status in a single statement
+        session['user']['admin'] = upsert_user_return_admin(username, email)
         session.pop('nonce', None)
 
     return redirect("/")
@@ -387,15 +535,20 @@ def home(page=1):
     Parameters:
     - page (int, optional): Page number to display (default is 1).
 
+    Query Parameters:
+    - cursor (str, optional): Cursor of the previous page's last item, used by the
+    "Next" link to seek to the page instead of offsetting.
+
     Returns:
     Rendered Template: Renders the 'home.html' template with the paginated
     news feed and session data.
     """
-    news_feed, total = get_home_feed(page)
-    total_pages = math.ceil(total / 10)
+    news_feed, total = get_home_feed(page, cursor=decode_cursor(request.args.get('cursor')))
+    total_pages = (total + 9) // 10
+    next_cursor = encode_cursor(news_feed[-1]) if news_feed else None
     return render_template('home.html', news_feed=news_feed,
                            total_pages=total_pages, current_page=page, session=session.get('user'),
-                           pretty=json.dumps(session.get('user'), indent=4))
+                           next_cursor=next_cursor)
 
 # Route to get latest 'k' news items
 @app.route('/newsfeed', methods=['GET'])
@@ -407,28 +560,31 @@ def get_news_feed():
     JSON Response: A JSON response containing the details of the latest news items.
 
     Notes:
-    - Queries the database for the latest news items, ordered by ID in descending order.
+    - Uses the highest news item ID and the number of news items as a weak ETag; if the
+    client already has that version, responds with 304 Not Modified without loading the
+    news items. The count changes when a story is stored with an ID below the highest one.
+    - Queries only the returned columns of the latest news items, ordered by ID
+    in descending order.
     - Limits the result to the latest 30 news items.
     - Constructs a list of dictionaries containing details of each news item.
     - Closes the database session after retrieving the data.
-    - Returns a JSON response with the list of news items.
-    """
-    session = Session()
-    latest_news = session.query(NewsItem).order_by(NewsItem.id.desc()).limit(30).all()
-    news_list = []
-    for news_item in latest_news:
-        news_list.append({
-            'id': news_item.id,
-            'title': news_item.title,
-            'by': news_item.by,
-            'url': news_item.url,
-            'descendants': news_item.descendants,
-            'score': news_item.score,
-            'time': news_item.time,
-            'text': news_item.text
-        })
-    session.close()
-    return jsonify(news_list)
+    - Returns a JSON response with the list of news items that clients and proxies
+    may cache for 30 seconds.
+    """
+    with ReadSession() as session:
+        max_id, count = session.query(func.max(NewsItem.id), # pylint: disable=not-callable
+                                      func.count(NewsItem.id)).one() # pylint: disable=not-callable
+        etag = f"{max_id or 0}-{count}"
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+        else:
+            latest_news = session.query(*NEWS_COLUMNS).order_by(
+                NewsItem.id.desc()).limit(30).all()
+            response = jsonify([dict(zip(NEWS_FIELDS, row)) for row in latest_news])
+    response.set_etag(etag, weak=True)
+    response.cache_control.public = True
+    response.cache_control.max_age = 30
+    return response
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,15 @@
+"""
+Test configuration: points the app at a temporary database and cache directory before
+update_database is imported, so the tests never touch the production data.
+"""
+import os
+import shutil
+import tempfile
+
+TEST_DIR = tempfile.mkdtemp(prefix='newsfeed_tests_')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(TEST_DIR, 'news_database.db')}"
+os.environ['CACHE_DIR'] = os.path.join(TEST_DIR, 'cache')
+
+def pytest_unconfigure(config): # pylint: disable=unused-argument
+    """Removes the temporary database and cache."""
+    shutil.rmtree(TEST_DIR, ignore_errors=True)
@@ -1,6 +1,20 @@
+import asyncio
+import base64
 import json
+import threading
+import aiohttp
 import pytest
-from app import app
+from aiohttp import web
+from sqlalchemy import delete, event, select
+import update_database
+from app import app, cache, datetimeformat, decode_cursor, encode_cursor, get_home_feed
+from update_database import (HttpCache, LikesAndDislikes, NewsItem, User, add_like_dislike,
+                             add_user, clear_news_item_cache, load_http_cache, writer_engine)
+
+# The tests run against the temporary database set up in conftest.py. Rows they create use
+# negative IDs and are removed afterwards, so the tests do not depend on each other.
+TEST_NEWS_ITEM_ID = -1000
+TEST_STORY_IDS = [-2001, -2002]
 
 @pytest.fixture
 def client():
@@ -8,6 +22,93 @@ def client():
     with app.test_client() as client:
         yield client
 
+@pytest.fixture
+def news_item():
+    with writer_engine.begin() as connection:
+        connection.execute(NewsItem.__table__.insert(), {'id': TEST_NEWS_ITEM_ID, 'title': 't'})
+    yield TEST_NEWS_ITEM_ID
+    with writer_engine.begin() as connection:
+        connection.execute(delete(LikesAndDislikes).where(
+            LikesAndDislikes.news_item_id == TEST_NEWS_ITEM_ID))
+        connection.execute(delete(NewsItem).where(NewsItem.id == TEST_NEWS_ITEM_ID))
+
+@pytest.fixture
+def voters():
+    emails = ['voter1@test.invalid', 'voter2@test.invalid']
+    yield [add_user(email.split('@')[0], email)['email'] for email in emails]
+    delete_users(emails)
+
+@pytest.fixture
+def hacker_news(monkeypatch):
+    """
+    Serves a fake Hacker News API on localhost. The first story fails twice with 503 and
+    then supports ETag revalidation; the second one has been deleted and returns null.
+    Yields the list of (item, If-None-Match) requests received.
+    """
+    requests_seen = []
+    failures = {'left': 2}
+
+    async def top_stories(request):
+        requests_seen.append(('top', request.headers.get('If-None-Match')))
+        if request.headers.get('If-None-Match') == '"top-1"':
+            return web.Response(status=304)
+        return web.json_response(TEST_STORY_IDS, headers={'ETag': '"top-1"'})
+
+    async def item(request):
+        item_id = int(request.match_info['item_id'])
+        requests_seen.append((item_id, request.headers.get('If-None-Match')))
+        if item_id != TEST_STORY_IDS[0]:
+            return web.json_response(None)
+        if failures['left']:
+            failures['left'] -= 1
+            return web.Response(status=503)
+        if request.headers.get('If-None-Match') == '"item-1"':
+            return web.Response(status=304)
+        return web.json_response({'id': item_id, 'title': 't', 'by': 'b', 'url': 'u'},
+                                 headers={'ETag': '"item-1"'})
+
+    server = web.Application()
+    server.router.add_get('/topstories.json', top_stories)
+    server.router.add_get('/item/{item_id}.json', item)
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(server)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', 0).start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    base_url = f"http://127.0.0.1:{runner.addresses[0][1]}"
+    monkeypatch.setattr(update_database, 'TOP_STORIES_URL', f"{base_url}/topstories.json")
+    monkeypatch.setattr(update_database, '_news_item_url',
+                        lambda item_id: f"{base_url}/item/{item_id}.json")
+    monkeypatch.setattr(update_database, 'BACKOFF_FACTOR', 0)
+    clear_news_item_cache()
+    yield requests_seen
+
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+    clear_news_item_cache()
+    with writer_engine.begin() as connection:
+        connection.execute(delete(NewsItem).where(NewsItem.id.in_(TEST_STORY_IDS)))
+        connection.execute(delete(HttpCache))
+
+def delete_users(emails):
+    with writer_engine.begin() as connection:
+        connection.execute(delete(User).where(User.email.in_(emails)))
+
+def counters(news_item_id):
+    with writer_engine.connect() as connection:
+        return tuple(connection.execute(
+            select(NewsItem.likes_count, NewsItem.dislikes_count).where(
+                NewsItem.id == news_item_id)).one())
+
+def votes(news_item_id):
+    with writer_engine.connect() as connection:
+        return connection.execute(select(LikesAndDislikes.like).where(
+            LikesAndDislikes.news_item_id == news_item_id)).scalars().all()
+
 def test_home_page(client):
     response = client.get('/')
     assert response.status_code == 200
@@ -18,6 +119,23 @@ def test_get_news_feed(client):
     data = json.loads(response.data)
     assert isinstance(data, list)
 
+def test_news_feed_etag_changes_when_older_item_is_added(client, request):
+    etag = client.get('/newsfeed').headers['ETag']
+    assert client.get('/newsfeed', headers={'If-None-Match': etag}).status_code == 304
+
+    request.getfixturevalue('news_item')
+    response = client.get('/newsfeed', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+def test_json_provider_accepts_non_string_keys():
+    # The provider also serializes the session cookie
+    assert json.loads(app.json.dumps({1: 'a', 'b': 2})) == {'1': 'a', 'b': 2}
+
+def test_datetimeformat():
+    assert datetimeformat(0) == '1970-01-01 00:00:00'
+    assert datetimeformat(None) == ''
+
 def test_login_page(client):
     response = client.get('/login')
     assert response.status_code == 302  # Redirects to Auth0 login page
@@ -62,6 +180,177 @@ def test_home_page_with_invalid_page_param(client):
     response = client.get('/page/invalid')
     assert response.status_code == 404
 
+def test_cursor_round_trip():
+    news_item = {'id': 7, 'likes': 3, 'dislikes': 1, 'time': 1700000000, 'title': 't'}
+    assert decode_cursor(encode_cursor(news_item)) == [3, 1, 1700000000, 7]
+
+@pytest.mark.parametrize('position', [
+    b'[9223372036854775808,0,0,0]', b'[-9223372036854775809,0,0,0]', b'[true,false,0,0]',
+    b'[1.5,0,0,0]', b'[0,0,0]', b'{}', b'not json'])
+def test_invalid_cursor_falls_back_to_offset(client, position):
+    cursor = base64.urlsafe_b64encode(position).decode()
+    assert decode_cursor(cursor) is None
+    response = client.get('/page/2', query_string={'cursor': cursor})
+    assert response.status_code == 200
+
+def test_garbage_cursor_falls_back_to_offset(client):
+    response = client.get('/page/2', query_string={'cursor': '%%%not base64'})
+    assert response.status_code == 200
+
+@pytest.fixture
+def ranked_news_items():
+    # Repeated vote counts and times, so the cursor has to break ties on every column
+    items = [{'id': -3000 - number, 'title': 't', 'time': 1700000000 + number // 7,
+              'likes_count': number % 3, 'dislikes_count': number % 2} for number in range(45)]
+    with writer_engine.begin() as connection:
+        connection.execute(NewsItem.__table__.insert(), items)
+    cache.delete_memoized(get_home_feed)
+    yield [item['id'] for item in items]
+    with writer_engine.begin() as connection:
+        connection.execute(delete(NewsItem).where(NewsItem.id.in_([item['id'] for item in items])))
+    cache.delete_memoized(get_home_feed)
+
+def test_cursor_pages_match_offset_pages(ranked_news_items):
+    cursor = None
+    seen = []
+    for page in range(1, 6):
+        offset_feed, _ = get_home_feed(page)
+        cursor_feed, _ = get_home_feed(page, cursor=cursor)
+        assert [item['id'] for item in cursor_feed] == [item['id'] for item in offset_feed]
+        seen += [item['id'] for item in cursor_feed]
+        cursor = decode_cursor(encode_cursor(cursor_feed[-1]))
+    assert sorted(seen) == sorted(ranked_news_items)
+
+def test_vote_insert_switch_and_withdraw(news_item, voters):
+    assert add_like_dislike(voters[0], news_item, True)
+    assert votes(news_item) == [True]
+    assert counters(news_item) == (1, 0)
+
+    assert add_like_dislike(voters[0], news_item, False)
+    assert votes(news_item) == [False]
+    assert counters(news_item) == (0, 1)
+
+    # Repeating the same vote withdraws it
+    assert add_like_dislike(voters[0], news_item, False)
+    assert votes(news_item) == []
+    assert counters(news_item) == (0, 0)
+
+def test_vote_on_missing_news_item(voters):
+    assert not add_like_dislike(voters[0], TEST_NEWS_ITEM_ID - 1, True)
+    assert votes(TEST_NEWS_ITEM_ID - 1) == []
+
+def test_like_route_for_missing_news_item(client, voters, monkeypatch):
+    # The foreign key rejects the vote; the user is sent back with an error, not a 500
+    monkeypatch.setattr(app, 'secret_key', 'test')
+    with client.session_transaction() as flask_session:
+        flask_session['user'] = {'userinfo': {'email': voters[0]}}
+    # The route only takes positive IDs; none are stored in the test database
+    response = client.post('/like/1')
+    assert response.status_code == 302
+    assert 'error=' in response.headers['Location']
+
+def test_vote_by_unknown_user(news_item):
+    assert not add_like_dislike('nobody@test.invalid', news_item, True)
+    assert counters(news_item) == (0, 0)
+
+def test_deleting_user_removes_their_votes_from_counters(news_item, voters):
+    assert add_like_dislike(voters[0], news_item, True)
+    assert add_like_dislike(voters[1], news_item, False)
+    assert counters(news_item) == (1, 1)
+
+    delete_users([voters[0]])
+    assert votes(news_item) == [False]
+    assert counters(news_item) == (0, 1)
+
+def test_vote_by_deleted_user_is_not_credited_to_new_user(news_item):
+    emails = ['alice@test.invalid', 'bob@test.invalid']
+    try:
+        add_user('alice', emails[0])
+        delete_users(emails[:1])
+        # Bob may be given Alice's old ID, which must not make Alice's email vote for him
+        add_user('bob', emails[1])
+
+        assert not add_like_dislike(emails[0], news_item, True)
+        assert votes(news_item) == []
+        assert counters(news_item) == (0, 0)
+
+        assert add_like_dislike(emails[1], news_item, True)
+        assert counters(news_item) == (1, 0)
+    finally:
+        delete_users(emails)
+
+def test_vote_after_user_signs_up_again(news_item, voters):
+    email = voters[0]
+    delete_users([email])
+    new_id = add_user('voter1', email)['id']
+    assert add_like_dislike(email, news_item, True)
+    with writer_engine.connect() as connection:
+        assert connection.execute(select(LikesAndDislikes.user_id).where(
+            LikesAndDislikes.news_item_id == news_item)).scalars().all() == [new_id]
+
+def test_ingestion_retries_and_revalidates(hacker_news, capsys):
+    update_database._ingest_top_stories() # pylint: disable=protected-access
+    assert capsys.readouterr().out.startswith('1 items saved')
+    # The first story was retried after two 503 responses
+    assert [seen for seen in hacker_news if seen[0] == TEST_STORY_IDS[0]] == [
+        (TEST_STORY_IDS[0], None)] * 3
+    assert {url.rsplit('/', 1)[-1]: entry['etag'] for url, entry in load_http_cache().items()
+            } == {'topstories.json': '"top-1"', f'{TEST_STORY_IDS[0]}.json': '"item-1"'}
+
+    hacker_news.clear()
+    clear_news_item_cache()
+    statements = []
+    def record_statement(conn, cursor, statement, *args): # pylint: disable=unused-argument
+        statements.append(statement)
+    event.listen(writer_engine, 'before_cursor_execute', record_statement)
+    try:
+        update_database._ingest_top_stories() # pylint: disable=protected-access
+    finally:
+        event.remove(writer_engine, 'before_cursor_execute', record_statement)
+    assert capsys.readouterr().out.startswith('0 items saved')
+    # Nothing changed, so the stored responses are not written again
+    assert not [statement for statement in statements if 'http_cache' in statement]
+    # Cached responses were revalidated with their ETags and reused on 304
+    assert sorted(hacker_news, key=str) == sorted([
+        ('top', '"top-1"'), (TEST_STORY_IDS[0], '"item-1"'), (TEST_STORY_IDS[1], None)], key=str)
+
+def test_get_json_retries_timeouts_and_skips_invalid_bodies(monkeypatch):
+    monkeypatch.setattr(update_database, 'BACKOFF_FACTOR', 0)
+    slow_requests = []
+
+    async def slow(request):
+        slow_requests.append(request.path)
+        if len(slow_requests) == 1:
+            await asyncio.sleep(1)
+        return web.json_response([1])
+
+    async def invalid(request):
+        return web.Response(body=b'{not json', headers={'ETag': '"bad"'})
+
+    async def fetch():
+        server = web.Application()
+        server.router.add_get('/slow', slow)
+        server.router.add_get('/invalid', invalid)
+        runner = web.AppRunner(server)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        base_url = f"http://127.0.0.1:{runner.addresses[0][1]}"
+        http_cache = {}
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=0.3)) as http:
+                return (await update_database.get_json(http, f"{base_url}/slow", http_cache),
+                        await update_database.get_json(http, f"{base_url}/invalid", http_cache),
+                        http_cache)
+        finally:
+            await runner.cleanup()
+
+    slow_result, invalid_result, http_cache = asyncio.run(fetch())
+    # The first request timed out and was retried
+    assert slow_result == [1]
+    assert len(slow_requests) == 2
+    assert invalid_result is None
+    assert not http_cache
+
 def test_error_logging():
     # You can add a test to check if error logging works as expected
     # This might require modifying the app to expose the logger or error log file path
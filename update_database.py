@@ -7,30 +7,55 @@ adding users, handling likes and dislikes, and updating the database with top ne
 Dependencies:
 - datetime: Provides functions for working with dates and times.
 - logging: Logging library for error tracking.
+- os: Reads the optional DATABASE_URL environment variable.
 - sqlalchemy: SQL toolkit and Object-Relational Mapping (ORM) for database interactions.
-- requests: HTTP library for making requests.
+- cachetools: LRU cache for fetched news items.
+- asyncio: Runs the Hacker News requests concurrently.
+- aiohttp: Asynchronous HTTP library for making requests.
+- orjson: Fast JSON library for parsing the Hacker News responses.
 
 Usage:
-- Run this file to initialize the database schema and update it with the latest top news items.
+- Run this file to initialize the database schema, update it with the latest top news items
+and refresh the like/dislike counters used to rank the home feed.
 
 Database Schema:
 - NewsItem: Represents a news item with various properties such as title, author, URL, etc.
 - User: Represents a user with a unique username, email, and admin status.
 - LikesAndDislikes: Represents the likes and dislikes of users for news items.
+- HttpCache: Stores the last Hacker News response and its cache validators per URL.
 
 Functions:
-- get_news_item(item_id): Retrieves details of a news item by its ID from the Hacker News API.
+- get_news_item(http, item_id, http_cache): Retrieves details of a news item by its ID from the
+Hacker News API.
+- get_json(http, url, http_cache): Fetches a JSON document, retrying transient failures and
+revalidating cached responses.
+- load_http_cache(): Returns the stored Hacker News responses by URL.
+- save_http_cache(http_cache, urls, stored): Stores the changed responses of the given URLs and
+drops the rest.
+- clear_news_item_cache(): Drops the news items remembered by get_news_item.
+- get_top_news_items(limit): Retrieves the top stories from the Hacker News API concurrently.
 - add_user(username, email): Adds a new user to the database or returns the existing user.
+- upsert_user_return_admin(username, email): Adds a user if needed and returns their admin status.
 - add_like_dislike(email, news_item_id, like): Adds or updates a user's like or dislike for a
 news item.
+- recount_likes_dislikes(connection): Recomputes the like/dislike counters of all news items.
+- upgrade_schema(bind): Adds columns and indexes missing from an existing database.
 
 """
+import asyncio
 import datetime
 import logging
-from sqlalchemy import create_engine, Column, String, Integer, ForeignKey, Boolean
+import os
+from types import MappingProxyType
+from cachetools import LRUCache
+from sqlalchemy import (create_engine, event, inspect, select, text, update, delete, func, cast,
+                        bindparam, Column, String, Integer, ForeignKey, Boolean, Index, LargeBinary)
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-import requests
+from sqlalchemy.orm import scoped_session, sessionmaker
+import aiohttp
+import orjson
 
 logging.basicConfig(filename='update_database.log', level=logging.INFO,
                     format='%(asctime)s:%(levelname)s:%(message)s')
@@ -51,6 +76,8 @@ class NewsItem(Base):
     - score (int): Score of the news item.
     - time (int): Timestamp of the news item.
     - text (str): Text content of the news item.
+    - likes_count (int): Number of likes, kept in sync by triggers on likes_and_dislikes.
+    - dislikes_count (int): Number of dislikes, kept in sync by triggers on likes_and_dislikes.
     """
     __tablename__ = "news_item"
     id = Column(Integer, primary_key=True)
@@ -61,6 +88,12 @@ class NewsItem(Base):
     score = Column(Integer)
     time = Column(Integer)
     text = Column(String)
+    likes_count = Column(Integer, nullable=False, default=0, server_default='0')
+    dislikes_count = Column(Integer, nullable=False, default=0, server_default='0')
+
+# Matches the home feed ordering so a page is read, or seeked to, straight off the index
+Index('ix_news_ranking', NewsItem.likes_count.desc(), NewsItem.dislikes_count.desc(),
+      NewsItem.time.desc(), NewsItem.id.desc())
 
 class User(Base):
     """
@@ -91,46 +124,446 @@ class LikesAndDislikes(Base):
     - like (bool): Like status (True for like, False for dislike).
     """
     __tablename__ = 'likes_and_dislikes'
+    # ix_ld_news_like covers the per-news-item vote aggregation without reading the table
+    # rows; ix_ld_user_item finds a user's vote on an item and allows only one such vote
+    __table_args__ = (Index('ix_ld_news_like', 'news_item_id', 'like'),
+                      Index('ix_ld_user_item', 'user_id', 'news_item_id', unique=True))
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('user.id'), nullable=False)
+    # Deleting a user deletes their likes and dislikes in the same statement
+    user_id = Column(Integer, ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
     news_item_id = Column(Integer, ForeignKey('news_item.id'), nullable=False)
     like = Column(Boolean, nullable=False)
 
+class HttpCache(Base):
+    """
+    Database model for storing the last response of a Hacker News API request.
+
+    Attributes:
+    - url (str): The requested URL.
+    - etag (str): ETag header of the response, sent back as If-None-Match.
+    - last_modified (str): Last-Modified header of the response, sent back as
+    If-Modified-Since.
+    - body (bytes): The JSON body of the response, reused when the server answers
+    304 Not Modified.
+    """
+    __tablename__ = 'http_cache'
+    url = Column(String, primary_key=True)
+    etag = Column(String)
+    last_modified = Column(String)
+    body = Column(LargeBinary, nullable=False)
+
+# Keep the NewsItem counters in sync with every change to likes_and_dislikes, including
+# rows removed by the ON DELETE CASCADE from user
+COUNTER_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS likes_and_dislikes_insert
+    AFTER INSERT ON likes_and_dislikes BEGIN
+        UPDATE news_item SET likes_count = likes_count + NEW."like",
+                             dislikes_count = dislikes_count + 1 - NEW."like"
+        WHERE id = NEW.news_item_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS likes_and_dislikes_update
+    AFTER UPDATE ON likes_and_dislikes BEGIN
+        UPDATE news_item SET likes_count = likes_count - OLD."like",
+                             dislikes_count = dislikes_count - 1 + OLD."like"
+        WHERE id = OLD.news_item_id;
+        UPDATE news_item SET likes_count = likes_count + NEW."like",
+                             dislikes_count = dislikes_count + 1 - NEW."like"
+        WHERE id = NEW.news_item_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS likes_and_dislikes_delete
+    AFTER DELETE ON likes_and_dislikes BEGIN
+        UPDATE news_item SET likes_count = likes_count - OLD."like",
+                             dislikes_count = dislikes_count - 1 + OLD."like"
+        WHERE id = OLD.news_item_id;
+    END""",
+)
+
+def _rebuild_likes_and_dislikes(connection):
+    """
+    Recreates likes_and_dislikes from the model, keeping its rows.
+
+    SQLite cannot alter a foreign key in place, so this is how an existing table gets
+    ON DELETE CASCADE. Rows without a like status, referencing deleted users or news
+    items, or repeating a user's vote on the same item are dropped.
+
+    Parameters:
+    - connection (Connection): The connection whose transaction the rebuild belongs to.
+
+    Returns:
+    - None
+    """
+    table = LikesAndDislikes.__table__
+    for index in table.indexes:
+        connection.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+    connection.execute(text("ALTER TABLE likes_and_dislikes RENAME TO likes_and_dislikes_old"))
+    table.create(connection)
+    connection.execute(text(
+        'INSERT INTO likes_and_dislikes (id, user_id, news_item_id, "like") '
+        'SELECT id, user_id, news_item_id, "like" FROM likes_and_dislikes_old '
+        'WHERE user_id IN (SELECT id FROM user) '
+        'AND news_item_id IN (SELECT id FROM news_item) AND "like" IS NOT NULL '
+        'AND id IN (SELECT min(id) FROM likes_and_dislikes_old '
+        'GROUP BY user_id, news_item_id)'))
+    connection.execute(text("DROP TABLE likes_and_dislikes_old"))
+
+def upgrade_schema(bind):
+    """
+    Brings an existing database up to date with the models defined above.
+
+    Missing tables are created with create_all; columns, indexes, foreign key actions and
+    triggers added to existing tables are created here. The like/dislike counters are
+    recomputed whenever existing votes had to be migrated.
+
+    Parameters:
+    - bind (Engine): The engine connected to the database to upgrade.
+
+    Returns:
+    - None
+    """
+    # Inspecting inside the transaction holds the write lock (BEGIN IMMEDIATE on the writer
+    # engine) from the checks to the changes, so workers starting together upgrade once
+    with bind.begin() as connection:
+        Base.metadata.create_all(connection)
+        inspector = inspect(connection)
+        columns = {column['name'] for column in inspector.get_columns('news_item')}
+        indexes = {index['name'] for index in inspector.get_indexes('likes_and_dislikes')}
+        cascades = [foreign_key['options'].get('ondelete') == 'CASCADE'
+                    for foreign_key in inspector.get_foreign_keys('likes_and_dislikes')
+                    if foreign_key['referred_table'] == 'user']
+        if 'likes_count' not in columns:
+            for name in ('likes_count', 'dislikes_count'):
+                connection.execute(text(
+                    f"ALTER TABLE news_item ADD COLUMN {name} INTEGER NOT NULL DEFAULT 0"))
+        if not all(cascades):
+            _rebuild_likes_and_dislikes(connection)
+        if 'likes_count' not in columns or not all(cascades):
+            recount_likes_dislikes(connection)
+        for trigger in COUNTER_TRIGGERS:
+            connection.execute(text(trigger))
+        if 'ix_ld_user_item' not in indexes:
+            # Keep only the first vote of each user on each item so the unique index
+            # can be created; the delete trigger takes the extra votes off the counters
+            connection.execute(text(
+                'DELETE FROM likes_and_dislikes WHERE id NOT IN '
+                '(SELECT min(id) FROM likes_and_dislikes GROUP BY user_id, news_item_id)'))
+        # Superseded by ix_news_ranking, which also orders ties by id
+        connection.execute(text("DROP INDEX IF EXISTS ix_news_rank"))
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+def _vote_totals():
+    """
+    Builds a subquery with the number of votes and likes per news item.
+
+    Dislikes are derived as total - likes, so only one conditional aggregate is needed.
+
+    Returns:
+    - Subquery: Rows of (news_item_id, total, likes).
+    """
+    return select(LikesAndDislikes.news_item_id,
+                  func.count().label('total'), # pylint: disable=not-callable
+                  func.sum(cast(LikesAndDislikes.like, Integer) # pylint: disable=not-callable
+                           ).label('likes')
+                  ).group_by(LikesAndDislikes.news_item_id).subquery()
+
+def recount_likes_dislikes(connection):
+    """
+    Recomputes every news item's like/dislike counters from likes_and_dislikes.
+
+    The counters are normally kept in sync by triggers; this full refresh is run
+    with each database update so any drift is corrected, like refreshing a precomputed
+    ranking.
+
+    Parameters:
+    - connection (Connection): The connection whose transaction the updates belong to.
+
+    Returns:
+    - None
+    """
+    totals = _vote_totals()
+    connection.execute(update(NewsItem).values(likes_count=0, dislikes_count=0))
+    connection.execute(update(NewsItem).where(NewsItem.id == totals.c.news_item_id).values(
+        likes_count=totals.c.likes, dislikes_count=totals.c.total - totals.c.likes))
+
 # Database setup
-engine = create_engine('sqlite:////home/marija8t/project_part2/news_database.db')
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
-session = Session()
+# SQLite allows a single writer at a time while WAL lets readers run alongside it, so all
+# writes share one pooled connection and reads get a pool of their own. Each thread
+# (i.e. each Flask request) gets its own session from each engine.
+# DATABASE_URL points the module at another database, e.g. a temporary one for the tests
+DATABASE_URL = os.environ.get('DATABASE_URL',
+                              'sqlite:////home/marija8t/project_part2/news_database.db')
+# The compiled statement cache is sized above the default of 500 so that the app's queries
+# stay compiled alongside the module's prebuilt statements
+writer_engine = create_engine(DATABASE_URL, pool_size=1, max_overflow=0, pool_pre_ping=True,
+                              query_cache_size=1200)
+reader_engine = create_engine(DATABASE_URL, pool_size=8, pool_pre_ping=True,
+                              query_cache_size=1200)
+
+@event.listens_for(writer_engine, "connect")
+@event.listens_for(reader_engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record): # pylint: disable=unused-argument
+    """
+    Configures every new pooled connection:
+    - WAL journaling, so the app keeps reading while update_database.py writes.
+    - A busy timeout, so lock contention waits instead of failing with "database is locked".
+    - NORMAL synchronous mode, which is safe with WAL and avoids an fsync per commit.
+    - A 64 MB page cache.
+    - Foreign key enforcement, which SQLite leaves off, so that ON DELETE CASCADE applies.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=30000")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+@event.listens_for(writer_engine, "connect")
+def _disable_implicit_begin(dbapi_connection, connection_record): # pylint: disable=unused-argument
+    """
+    Stops pysqlite from issuing its own deferred BEGIN, so that _begin_immediate controls
+    when write transactions start.
+    """
+    dbapi_connection.isolation_level = None
+
+@event.listens_for(writer_engine, "begin")
+def _begin_immediate(connection):
+    """
+    Starts every write transaction with BEGIN IMMEDIATE. The write lock is taken up front,
+    so contention waits (or fails) at the start of the transaction instead of when a read
+    turns into a write halfway through it.
+    """
+    connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+upgrade_schema(writer_engine)
+WriteSession = scoped_session(sessionmaker(bind=writer_engine))
+ReadSession = scoped_session(sessionmaker(bind=reader_engine))
+
+# Statements run on every login and like/dislike, built once with bind parameters so each
+# call reuses the same statement object and its cached compiled SQL. INSERT parameters
+# are taken from the dictionary passed to execute().
+USER_COLUMNS = (User.id, User.username, User.email, User.admin)
+SELECT_USER = select(*USER_COLUMNS).where(User.email == bindparam('email'))
+INSERT_USER = insert(User).on_conflict_do_nothing(index_elements=['email']
+                                                  ).returning(*USER_COLUMNS)
+# The conflict update leaves the row unchanged; it is only needed so that
+# RETURNING also yields the admin flag of an existing user
+_upsert_user = insert(User)
+UPSERT_USER_ADMIN = _upsert_user.on_conflict_do_update(
+    index_elements=['email'], set_={'email': _upsert_user.excluded.email}
+    ).returning(User.admin)
+# Insert the vote, or switch an existing opposite vote. Nothing is returned when the
+# user repeats their vote, which DELETE_VOTE then withdraws. The user is looked up by
+# email inside each statement, so a vote is a single statement and can never be credited
+# to another user that took over a deleted user's ID.
+_voter = select(User.id).where(User.email == bindparam('email'))
+# Built on the table, as the ORM's INSERT handling does not accept INSERT ... SELECT
+_upsert_vote = insert(LikesAndDislikes.__table__).from_select(
+    ['user_id', 'news_item_id', 'like'],
+    _voter.add_columns(bindparam('news_item_id', type_=Integer),
+                       bindparam('like', type_=Boolean)))
+UPSERT_VOTE = _upsert_vote.on_conflict_do_update(
+    index_elements=['user_id', 'news_item_id'], set_={'like': _upsert_vote.excluded.like},
+    where=LikesAndDislikes.like != _upsert_vote.excluded.like
+    ).returning(LikesAndDislikes.id)
+DELETE_VOTE = delete(LikesAndDislikes).where(
+    LikesAndDislikes.user_id.in_(_voter.scalar_subquery()),
+    LikesAndDislikes.news_item_id == bindparam('news_item_id'))
+
+TOP_STORIES_URL = "https://hacker-news.firebaseio.com/v0/topstories.json?print=pretty"
+
+# Retry policy for Hacker News requests: transient server errors, dropped connections and
+# timeouts are retried with an exponential backoff of 0.2s, 0.4s, 0.8s
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.2
+RETRY_STATUSES = {500, 502, 503, 504}
+# Dropped connections, bodies cut off mid-transfer, and requests exceeding the timeout
+RETRY_EXCEPTIONS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+                    asyncio.TimeoutError)
+
+async def get_json(http, url, http_cache=None):
+    """
+    Fetches and parses a JSON document, retrying transient failures.
+
+    Parameters:
+    - http (aiohttp.ClientSession): The HTTP session used for the request. Its connections
+    are kept alive and reused between requests.
+    - url (str): The URL of the JSON document.
+    - http_cache (dict, optional): Cached responses by URL, as returned by load_http_cache.
+    A cached response is revalidated with If-None-Match/If-Modified-Since and its body is
+    reused on 304 Not Modified. Fresh responses are stored back into it.
+
+    Returns:
+    - dict, list or None: The parsed JSON, or None if the server did not return it or
+    returned invalid JSON. Invalid bodies are not cached.
+
+    Raises:
+    - aiohttp.ClientError or asyncio.TimeoutError: If the request still fails after all
+    retries.
+    """
+    cached = http_cache.get(url) if http_cache is not None else None
+    headers = {}
+    if cached and cached['etag']:
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached['last_modified']:
+        headers['If-Modified-Since'] = cached['last_modified']
+
+    for attempt in range(MAX_RETRIES + 1):
+        retry = attempt < MAX_RETRIES
+        try:
+            async with http.get(url, headers=headers) as response:
+                if response.status == 304 and cached:
+                    return orjson.loads(cached['body'])
+                if response.status == 200:
+                    body = await response.read()
+                    try:
+                        data = orjson.loads(body)
+                    except orjson.JSONDecodeError:
+                        return None
+                    if http_cache is not None:
+                        _store_response(http_cache, url, response.headers, body)
+                    return data
+                if not (retry and response.status in RETRY_STATUSES):
+                    return None
+        except RETRY_EXCEPTIONS:
+            if not retry:
+                raise
+        await asyncio.sleep(BACKOFF_FACTOR * 2 ** attempt)
+    return None
+
+def _store_response(http_cache, url, headers, body):
+    """
+    Records a fresh response in the HTTP cache, or drops the URL if the response cannot
+    be revalidated.
+    """
+    etag = headers.get('ETag')
+    last_modified = headers.get('Last-Modified')
+    if etag or last_modified:
+        http_cache[url] = {'url': url, 'etag': etag, 'last_modified': last_modified,
+                           'body': body}
+    else:
+        http_cache.pop(url, None)
+
+def load_http_cache():
+    """
+    Loads the stored Hacker News responses.
+
+    Returns:
+    - dict: The HttpCache rows as dictionaries, keyed by URL.
+    """
+    with reader_engine.connect() as connection:
+        rows = connection.execute(select(HttpCache.__table__)).mappings()
+        return {row['url']: dict(row) for row in rows}
+
+def save_http_cache(http_cache, urls, stored):
+    """
+    Stores the changed responses of the requested URLs and removes the entries of URLs that
+    were not requested, so the table only holds the current top stories. Responses that were
+    revalidated with 304 Not Modified are left as they are.
+
+    Parameters:
+    - http_cache (dict): Cached responses by URL, as updated by get_json.
+    - urls (list): The URLs requested in this run.
+    - stored (dict): The responses loaded by load_http_cache at the start of the run.
+
+    Returns:
+    None
+    """
+    entries = {url: http_cache[url] for url in urls if url in http_cache}
+    changed = [entry for url, entry in entries.items() if entry != stored.get(url)]
+    removed = [url for url in stored if url not in entries]
+    if not changed and not removed:
+        return
+    with writer_engine.begin() as connection:
+        if removed:
+            connection.execute(delete(HttpCache).where(HttpCache.url.in_(removed)))
+        if changed:
+            stmt = insert(HttpCache)
+            connection.execute(stmt.on_conflict_do_update(index_elements=['url'], set_={
+                'etag': stmt.excluded.etag,
+                'last_modified': stmt.excluded.last_modified,
+                'body': stmt.excluded.body,
+            }), changed)
+
+def _news_item_url(item_id):
+    """
+    Returns the Hacker News API URL of a news item.
+    """
+    return f"https://hacker-news.firebaseio.com/v0/item/{item_id}.json?print=pretty"
+
+# News items fetched in this process, by ID. The cached items are read-only proxies, so a
+# caller cannot change the copy shared with later lookups. Only found items are cached.
+_news_items = LRUCache(maxsize=512)
 
 # Function to get news item
-def get_news_item(item_id):
+async def get_news_item(http, item_id, http_cache=None):
     """
-    Fetches a news item from the Hacker News API based on the provided item ID.
+    Fetches a news item from the Hacker News API based on the provided item ID. Items already
+    fetched by this process are returned without a request.
 
     Parameters:
+    - http (aiohttp.ClientSession): The HTTP session used for the request.
     - item_id (int): The unique identifier of the news item.
+    - http_cache (dict, optional): Cached responses by URL, passed on to get_json.
 
     Returns:
-    - dict or None: A dictionary containing information about the news item if it exists,
-    or None if not found.
-    """
-    news_url = f"https://hacker-news.firebaseio.com/v0/item/{item_id}.json?print=pretty"
-    response = requests.get(news_url)
-    if response.status_code == 200:
-        news_data = response.json()
-        if 'title' in news_data and 'by' in news_data and 'url' in news_data:
-            return {
-                'id': news_data['id'],
-                'title': news_data['title'],
-                'by': news_data['by'],
-                'url': news_data.get('url', ''),
-                'descendants': news_data.get('descendants', 0),
-                'score': news_data.get('score', 0),
-                'time': news_data.get('time', 0),
-                'text': news_data.get('text', '')
-            }
+    - MappingProxyType or None: A read-only mapping containing information about the news
+    item if it exists, or None if not found.
+    """
+    news_item = _news_items.get(item_id)
+    if news_item is not None:
+        return news_item
+
+    news_data = await get_json(http, _news_item_url(item_id), http_cache)
+    if news_data and 'title' in news_data and 'by' in news_data and 'url' in news_data:
+        news_item = _news_items[item_id] = MappingProxyType({
+            'id': news_data['id'],
+            'title': news_data['title'],
+            'by': news_data['by'],
+            'url': news_data.get('url', ''),
+            'descendants': news_data.get('descendants', 0),
+            'score': news_data.get('score', 0),
+            'time': news_data.get('time', 0),
+            'text': news_data.get('text', '')
+        })
+        return news_item
     return None
 
+def clear_news_item_cache():
+    """
+    Forgets the news items cached by get_news_item, so they are fetched again.
+
+    Returns:
+    - None
+    """
+    _news_items.clear()
+
+async def get_top_news_items(limit=50):
+    """
+    Fetches the top stories from the Hacker News API, requesting all items concurrently.
+    Responses from previous runs are revalidated instead of downloaded again when possible.
+
+    Parameters:
+    - limit (int, optional): The number of top stories to fetch (default is 50).
+
+    Returns:
+    - list or None: The results of get_news_item for each top story, or None if the list of
+    top stories could not be fetched.
+    """
+    stored = load_http_cache()
+    http_cache = dict(stored)
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=limit)) as http:
+        top_story_ids = await get_json(http, TOP_STORIES_URL, http_cache)
+        if top_story_ids is None:
+            return None
+        top_story_ids = top_story_ids[:limit]
+        news_items = await asyncio.gather(*(get_news_item(http, item_id, http_cache)
+                                            for item_id in top_story_ids))
+    save_http_cache(http_cache, [TOP_STORIES_URL, *map(_news_item_url, top_story_ids)],
+                    stored)
+    return news_items
+
 def add_user(username, email):
     """
     Adds a new user to the database.
@@ -140,29 +573,48 @@ def add_user(username, email):
     - email (str): The email address of the new user.
 
     Returns:
-    - dict: A dictionary containing information about the added user.
+    - dict: A dictionary with the id, username, email and admin status of the added user, or
+    of the existing user with the same email.
 
     Raises:
     - Exception: Raises an exception if an error occurs during user addition.
     """
-    saved_users = 0
+    # Inserting first lets the unique email constraint decide whether the user exists,
+    # so two concurrent logins cannot both create the same user
     try:
-        with Session() as session:
-            existing_user = session.query(User).filter_by(email=email).first()
-            if existing_user:
-                return {'username': existing_user.username, 'email': existing_user.email,
-                        'admin': existing_user.admin}
-
-            #Create a new user and then add to the database
-            new_user = User(username=username, email=email)
-            session.add(new_user)
-            session.commit()
-            saved_users += 1
-            return {'username': new_user.username, 'email': new_user.email, 'admin': new_user.admin}
+        with writer_engine.begin() as connection:
+            user = connection.execute(INSERT_USER, {'username': username, 'email': email}
+                                      ).mappings().first()
+            if user is None:
+                user = connection.execute(SELECT_USER, {'email': email}).mappings().first()
+            return dict(user)
 
     except Exception as exception:
         raise Exception(f"Could not add user: {str(exception)}")
 
+def upsert_user_return_admin(username, email):
+    """
+    Adds a user to the database if needed and returns their admin status in one statement.
+
+    Parameters:
+    - username (str): The username of the user.
+    - email (str): The email address of the user.
+
+    Returns:
+    - bool: True if the user is an administrator, False otherwise.
+
+    Raises:
+    - Exception: Raises an exception if an error occurs during user addition.
+    """
+    try:
+        with WriteSession() as session:
+            admin = session.execute(UPSERT_USER_ADMIN,
+                                    {'username': username, 'email': email}).scalar()
+            session.commit()
+            return bool(admin)
+    except Exception as exception:
+        raise Exception(f"Could not add user: {str(exception)}")
+
 def add_like_dislike(email, news_item_id, like):
     """
     Handles user likes or dislikes for a news item.
@@ -175,57 +627,45 @@ def add_like_dislike(email, news_item_id, like):
     Returns:
     - bool: True if the like or dislike is successfully processed, False otherwise.
     """
-    with Session() as session:
-        user = session.query(User).filter_by(email=email).first()
-        if not user:
+    vote = {'email': email, 'news_item_id': news_item_id, 'like': like}
+    with WriteSession() as session:
+        try:
+            if session.execute(UPSERT_VOTE, vote).first() is None:
+                # Either a repeated vote, which is withdrawn, or an unknown user
+                if not session.execute(DELETE_VOTE, vote).rowcount:
+                    return False
+        except IntegrityError:
+            # The news item does not exist
+            session.rollback()
             return False
 
-        # Check if the user has already liked or disliked this news item
-        existing_record = session.query(
-            LikesAndDislikes).filter_by(user_id=user.id, news_item_id=news_item_id).first()
-        if existing_record:
-            if existing_record.like == like:
-                session.delete(existing_record)
-            else:
-                existing_record.like = like
-        else:
-            new_like_dislike = LikesAndDislikes(user_id=user.id,
-                                                news_item_id=news_item_id, like=like)
-            session.add(new_like_dislike)
-
         try:
             session.commit()
             return True
         except Exception as exception:
             raise Exception(f"Could not add user: {str(exception)}")
 
-# Fetch the list of top story IDs
-TOP_STORIES_URL = "https://hacker-news.firebaseio.com/v0/topstories.json?print=pretty"
-RESPONSE = requests.get(TOP_STORIES_URL)
-if RESPONSE.status_code == 200:
-    TOP_STORY_IDS = RESPONSE.json()[:50]  # Only first 50 items
-    SAVED_ITEMS = 0
-    for item_id in TOP_STORY_IDS:
-        news_data = get_news_item(item_id)
-        if news_data:
-            # Check if the item with the same ID already exists in the database
-            if not session.query(NewsItem).filter(NewsItem.id == item_id).first():
-                # Create a news item object and save it to the database
-                news_item = NewsItem(
-                    id=news_data['id'],
-                    title=news_data['title'],
-                    by=news_data['by'],
-                    url=news_data['url'],
-                    descendants=news_data['descendants'],
-                    score=news_data['score'],
-                    time=news_data['time'],
-                    text=news_data['text']
-                    # Add more properties as needed based on the JSON structure
-                )
-                session.add(news_item)
-                SAVED_ITEMS += 1
-
-    session.commit()
-    print(f"{SAVED_ITEMS} items saved to the database at {datetime.datetime.now()}")
-else:
-    print("Failed to fetch top story IDs.")
+def _ingest_top_stories():
+    """
+    Stores the current top stories in the database and refreshes the like/dislike counters.
+    """
+    news_items = asyncio.run(get_top_news_items())
+    if news_items is None:
+        print("Failed to fetch top story IDs.")
+        return
+
+    # The fetched dictionaries already use the NewsItem column names, so they are passed
+    # straight to an executemany INSERT without building ORM objects. Items that are
+    # already stored are skipped by the primary key (INSERT OR IGNORE).
+    fetched_items = [dict(news_data) for news_data in news_items if news_data]
+    saved_items = 0
+    with writer_engine.begin() as connection:
+        if fetched_items:
+            saved_items = connection.execute(
+                insert(NewsItem).on_conflict_do_nothing(index_elements=['id']),
+                fetched_items).rowcount
+        recount_likes_dislikes(connection)
+    print(f"{saved_items} items saved to the database at {datetime.datetime.now()}")
+
+if __name__ == "__main__":
+    _ingest_top_stories()